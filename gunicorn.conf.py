@@ -0,0 +1,17 @@
+"""
+Конфиг gunicorn для продакшена: несколько Uvicorn-воркеров.
+Запуск: gunicorn main:app  (файл подхватывается автоматически)
+
+Polling бота ведёт один воркер — тот, кто держит flock (см. main.py).
+"""
+
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_class = "uvicorn.workers.UvicornWorker"
+# Без access-логов на каждый запрос; логи самого приложения остаются на INFO
+loglevel = os.getenv("LOG_LEVEL", "warning")
+accesslog = None
+
@@ -4,28 +4,84 @@ Backend для Telegram Mini App: FastAPI + Aiogram 3.x
 """
 
 import os
+import json
 import asyncio
+import logging
+import tempfile
+import urllib.parse
 from contextlib import asynccontextmanager
-from typing import Optional, Dict, Any, List
+from typing import Optional, Dict, Any, List, Union
 
-from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import HTMLResponse, FileResponse, JSONResponse
+from fastapi import FastAPI, Request, HTTPException, BackgroundTasks
+from fastapi.responses import HTMLResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, StrictInt, field_validator
+import orjson
 
 from aiogram import Bot, Dispatcher, Router
 from aiogram.types import Message, FSInputFile, InlineKeyboardMarkup, InlineKeyboardButton, WebAppInfo
 from aiogram.filters import CommandStart
 from aiogram.enums import ParseMode
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
 
-from recommendation import recommend, load_programs
+try:
+    import fcntl
+except ImportError:  # Windows: один процесс, выбор лидера не нужен
+    fcntl = None
+
+# Корневой логгер остаётся на WARNING (aiogram не пишет строку на каждый апдейт),
+# INFO — только для логов самого приложения
+logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+log = logging.getLogger(__name__)
+log.setLevel(logging.INFO)
 
 # ===================== КОНФИГУРАЦИЯ =====================
 # Переменные окружения (настроить на хостинге)
 BOT_TOKEN = os.getenv("BOT_TOKEN")  # Токен бота из BotFather
 SITE_URL = os.getenv("SITE_URL")    # URL сайта на хостинге
+# Polling ведёт только процесс, взявший flock на этот файл — иначе N воркеров
+# gunicorn конкурируют за getUpdates. Остальные периодически пробуют взять лок,
+# поэтому polling переживает перезапуск воркеров и SIGHUP-reload
+POLLING_LOCK_FILE = os.getenv(
+    "POLLING_LOCK_FILE",
+    os.path.join(tempfile.gettempdir(), f"era_bot_{(BOT_TOKEN or '').split(':')[0]}.lock"),
+)
+POLLING_LOCK_RETRY = 5              # Как часто не-лидер пробует взять лок (сек)
 WELCOME_VIDEO_FILE_ID = None        # Кэш для ускорения отправки видео
+_video_lock = asyncio.Lock()        # Защищает первую загрузку видео
+POLLING_TIMEOUT = 30                # Таймаут long polling (сек)
+PROGRAMS_FILE = "programs.json"
+
+# Кэш programs.json — загружается один раз при импорте (см. load_programs_cache)
+ALL_PROGRAMS: List[Dict[str, Any]] = []
+TAG_INDEX: Dict[str, List[int]] = {}  # тег → индексы программ в ALL_PROGRAMS
+_PROGRAMS_JSON_BYTES: bytes = b"[]"
+# Готовые JSON-фрагменты списка "programs" для /webhook: тег → b'{...},{...}'
+_WEBHOOK_PROGRAMS_JSON: Dict[str, bytes] = {}
+_DEFAULT_PROGRAMS_JSON: bytes = b""
+
+WEBHOOK_MAX_PROGRAMS = 5    # Сколько программ отдаём по тегу
+WEBHOOK_DEFAULT_PROGRAMS = 3  # Сколько отдаём без тега / если по тегу ничего нет
+
+# ===================== СТАТИКА =====================
+def read_static(path: str) -> Optional[bytes]:
+    """Читает статический файл целиком (один раз при импорте)"""
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError as e:
+        log.warning("⚠️ Статический файл не загружен: %s", e)
+        return None
+
+_ROOT_HTML = b"""
+    <html>
+        <head><meta http-equiv="refresh" content="0; url=/quiz"></head>
+        <body>Redirecting...</body>
+    </html>
+    """
+_INDEX_BYTES = read_static("index.html")
+_QUIZ_DATA_BYTES = read_static("quiz_data.json")
 
 if not BOT_TOKEN:
     raise ValueError("❌ BOT_TOKEN environment variable is required!")
@@ -34,7 +90,9 @@ if not SITE_URL:
 
 # ===================== МОДЕЛИ ДАННЫХ =====================
 class QuizAnswers(BaseModel):
-    uid: str
+    # Telegram user id разбирается в int один раз при валидации;
+    # вне Telegram квиз шлёт строку (например "test_user") — она остаётся str
+    uid: Union[StrictInt, str]
     selected_tag: Optional[str] = None
     history: Optional[List[str]] = None
     # Старые поля для обратной совместимости
@@ -45,13 +103,47 @@ class QuizAnswers(BaseModel):
     location: Optional[str] = None
     interests: Optional[List[str]] = None
 
+    @field_validator("uid", mode="before")
+    @classmethod
+    def parse_telegram_uid(cls, value: Any) -> Any:
+        """
+        В int — только положительные id: int (не bool) или строка из ASCII-цифр.
+        Отрицательные id (группы/каналы) и прочие строки остаются str.
+        """
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value if value > 0 else str(value)
+        if isinstance(value, str) and value.isascii() and value.isdigit() and int(value) > 0:
+            return int(value)
+        return value
+
+
 class TildaWebhookData(BaseModel):
     """Данные от Tilda вебхука"""
     uid: str
     answers: Dict[str, Any]
 
 # ===================== AIOGRAM BOT =====================
-bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+class KeepAliveAiohttpSession(AiohttpSession):
+    """
+    AiohttpSession (один пул соединений к api.telegram.org) с более долгим
+    keep-alive у TCPConnector. aiogram не пробрасывает параметры коннектора,
+    поэтому дополняем приватный _connector_init (есть в aiogram 3.x).
+    Если в новой версии его нет — остаётся стандартный коннектор aiogram.
+    """
+
+    def __init__(self, keepalive_timeout: float = 60, **kwargs: Any):
+        super().__init__(**kwargs)
+        connector_init = getattr(self, "_connector_init", None)
+        if isinstance(connector_init, dict):
+            connector_init.setdefault("keepalive_timeout", keepalive_timeout)
+        else:
+            log.warning("⚠️ AiohttpSession без _connector_init — keepalive_timeout не применён")
+
+bot = Bot(
+    token=BOT_TOKEN,
+    session=KeepAliveAiohttpSession(),
+    default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+)
 dp = Dispatcher()
 router = Router()
 
@@ -61,7 +153,6 @@ async def cmd_start(message: Message):
     user_id = message.from_user.id
     first_name = message.from_user.first_name or "Гость"
     # Экранируем имя для URL
-    import urllib.parse
     safe_name = urllib.parse.quote(first_name)
     quiz_url = f"{SITE_URL}/quiz?uid={user_id}&name={safe_name}"
     
@@ -90,51 +181,144 @@ async def cmd_start(message: Message):
     global WELCOME_VIDEO_FILE_ID
     
     try:
-        # Если видео уже загружалось, отправляем по file_id (мгновенно)
-        if WELCOME_VIDEO_FILE_ID:
-            await message.answer_video(
-                video=WELCOME_VIDEO_FILE_ID,
-                caption=welcome_text,
-                reply_markup=keyboard
-            )
-            print(f"✅ Видео отправлено (из кэша) пользователю {user_id}")
-        else:
-            # Если первый раз — загружаем файл
-            video_file = FSInputFile(video_path)
-            sent_message = await message.answer_video(
-                video=video_file,
-                caption=welcome_text,
-                reply_markup=keyboard
-            )
-            # Сохраняем file_id для будущего использования
-            WELCOME_VIDEO_FILE_ID = sent_message.video.file_id
-            print(f"✅ Видео загружено и кэшировано (file_id: {WELCOME_VIDEO_FILE_ID})")
+        if WELCOME_VIDEO_FILE_ID is None:
+            # Первый раз — загружаем файл. Под локом с повторной проверкой:
+            # параллельные /start ждут первую загрузку, а не шлют видео заново
+            async with _video_lock:
+                if WELCOME_VIDEO_FILE_ID is None:
+                    video_file = FSInputFile(video_path)
+                    sent_message = await message.answer_video(
+                        video=video_file,
+                        caption=welcome_text,
+                        reply_markup=keyboard
+                    )
+                    # Сохраняем file_id для будущего использования
+                    WELCOME_VIDEO_FILE_ID = sent_message.video.file_id
+                    log.info("✅ Видео загружено и кэшировано (file_id: %s)", WELCOME_VIDEO_FILE_ID)
+                    return
+        
+        # Видео уже загружалось — отправляем по file_id (мгновенно)
+        await message.answer_video(
+            video=WELCOME_VIDEO_FILE_ID,
+            caption=welcome_text,
+            reply_markup=keyboard
+        )
+        log.info("✅ Видео отправлено (из кэша) пользователю %s", user_id)
             
     except FileNotFoundError:
-        print(f"⚠️ Видео не найдено: {video_path}")
+        log.warning("⚠️ Видео не найдено: %s", video_path)
         await message.answer(welcome_text, reply_markup=keyboard)
     except Exception as e:
-        print(f"❌ Ошибка отправки видео: {e}")
+        log.error("❌ Ошибка отправки видео: %s", e)
         await message.answer(welcome_text, reply_markup=keyboard)
 
 dp.include_router(router)
 
+# ===================== КЭШ ПРОГРАММ =====================
+def load_programs_cache():
+    """Читает programs.json в память, строит индекс тег → программы и JSON-фрагменты /webhook"""
+    global ALL_PROGRAMS, TAG_INDEX, _PROGRAMS_JSON_BYTES
+    global _WEBHOOK_PROGRAMS_JSON, _DEFAULT_PROGRAMS_JSON
+    try:
+        with open(PROGRAMS_FILE, 'rb') as f:
+            raw = f.read()
+        programs = json.loads(raw)
+    except (OSError, ValueError) as e:
+        # Без программ /webhook и /programs.json молча отдавали бы пустые списки
+        raise RuntimeError(f"❌ Не удалось загрузить {PROGRAMS_FILE}: {e}") from e
+    
+    # Инвертированный индекс тег → позиции программ; каждую программу
+    # сериализуем один раз, ответы /webhook потом собираются из готовых байтов
+    tag_index: Dict[str, List[int]] = {}
+    for i, program in enumerate(programs):
+        for tag in dict.fromkeys(program.get('tags', [])):
+            tag_index.setdefault(tag, []).append(i)
+    fragments = [orjson.dumps(program) for program in programs]
+    
+    ALL_PROGRAMS = programs
+    TAG_INDEX = tag_index
+    _PROGRAMS_JSON_BYTES = raw
+    _WEBHOOK_PROGRAMS_JSON = {
+        tag: b",".join(fragments[i] for i in positions[:WEBHOOK_MAX_PROGRAMS])
+        for tag, positions in tag_index.items()
+    }
+    _DEFAULT_PROGRAMS_JSON = b",".join(fragments[:WEBHOOK_DEFAULT_PROGRAMS])
+    log.info("📦 Загружено программ: %d, тегов: %d", len(programs), len(tag_index))
+
+# Как и статика — при импорте, чтобы кэш не зависел от запуска lifespan
+load_programs_cache()
+
+# ===================== POLLING =====================
+async def run_polling_when_elected():
+    """
+    Ждёт эксклюзивный flock на POLLING_LOCK_FILE и запускает polling бота.
+    Лок снимается, когда polling остановлен, а при падении воркера — самой ОС,
+    после чего его подхватывает другой воркер.
+    """
+    lock_error = None
+    while True:
+        lock_file = None
+        if fcntl is not None:
+            try:
+                lock_file = open(POLLING_LOCK_FILE, "a")
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError as e:
+                if lock_file is not None:
+                    lock_file.close()
+                # Лок держит другой воркер — штатно; прочие ошибки (путь, права,
+                # ENOLCK) логируем, иначе бот молча не будет отвечать
+                if not isinstance(e, BlockingIOError) and str(e) != lock_error:
+                    lock_error = str(e)
+                    log.error("❌ Не удалось взять лок polling %s: %s (повтор каждые %s с)",
+                              POLLING_LOCK_FILE, e, POLLING_LOCK_RETRY)
+                await asyncio.sleep(POLLING_LOCK_RETRY)
+                continue
+        
+        try:
+            log.info("🤖 Бот запущен (pid %s)! SITE_URL: %s", os.getpid(), SITE_URL)
+            await dp.start_polling(bot, polling_timeout=POLLING_TIMEOUT, handle_signals=False)
+            return
+        except Exception as e:
+            log.error("❌ Polling остановлен с ошибкой: %s", e)
+        finally:
+            if lock_file is not None:
+                lock_file.close()
+        await asyncio.sleep(POLLING_LOCK_RETRY)
+
 # ===================== FASTAPI APP =====================
+class ORJSONResponse(Response):
+    """JSON-ответ через orjson (сериализация в C, быстрее stdlib json)"""
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Жизненный цикл приложения — запуск бота"""
-    # Запуск polling в фоне (только если токен настроен)
+    # Запуск polling в фоне (только если токен настроен).
+    # Long polling 30 с вместо 10 — реже пустые запросы getUpdates.
+    # Сигналы обрабатывает uvicorn, остановка — через отмену задачи
+    app.state.polling_task = None
     if BOT_TOKEN != "YOUR_BOT_TOKEN_HERE":
-        asyncio.create_task(dp.start_polling(bot))
-        print(f"🤖 Бот запущен! SITE_URL: {SITE_URL}")
+        app.state.polling_task = asyncio.create_task(run_polling_when_elected())
     else:
-        print(f"⚠️ BOT_TOKEN не настроен, бот не запущен. SITE_URL: {SITE_URL}")
+        log.warning("⚠️ BOT_TOKEN не настроен, бот не запущен. SITE_URL: %s", SITE_URL)
     yield
+    if app.state.polling_task is not None:
+        app.state.polling_task.cancel()
+        (result,) = await asyncio.gather(app.state.polling_task, return_exceptions=True)
+        if isinstance(result, Exception):
+            log.error("❌ Задача polling завершилась с ошибкой: %r", result)
     if BOT_TOKEN != "YOUR_BOT_TOKEN_HERE":
         await bot.session.close()
-        print("🤖 Бот остановлен")
+        log.info("🤖 Бот остановлен")
 
-app = FastAPI(title="Era Entertainment Bot", lifespan=lifespan)
+app = FastAPI(
+    title="Era Entertainment Bot",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 # CORS для работы с Tilda и другими фронтендами
 app.add_middleware(
@@ -150,85 +334,104 @@ app.add_middleware(
 @app.get("/", response_class=HTMLResponse)
 async def root():
     """Главная страница — редирект на квиз"""
-    return """
-    <html>
-        <head><meta http-equiv="refresh" content="0; url=/quiz"></head>
-        <body>Redirecting...</body>
-    </html>
-    """
+    return HTMLResponse(content=_ROOT_HTML)
 
 @app.get("/quiz", response_class=HTMLResponse)
 async def serve_quiz():
-    """Отдаём HTML страницу с квизом"""
-    return FileResponse("index.html")
+    """Отдаём HTML страницу с квизом (из памяти)"""
+    if _INDEX_BYTES is None:
+        raise HTTPException(status_code=404, detail="index.html not found")
+    return Response(content=_INDEX_BYTES, media_type="text/html")
 
 @app.get("/quiz_data.json")
 async def serve_quiz_data():
-    """Отдаём данные квиза"""
-    return FileResponse("quiz_data.json")
+    """Отдаём данные квиза (из памяти)"""
+    if _QUIZ_DATA_BYTES is None:
+        raise HTTPException(status_code=404, detail="quiz_data.json not found")
+    return Response(content=_QUIZ_DATA_BYTES, media_type="application/json")
 
 @app.get("/programs.json")
 async def serve_programs():
-    """Отдаём список программ"""
-    return FileResponse("programs.json")
+    """Отдаём список программ (из кэша в памяти)"""
+    return Response(content=_PROGRAMS_JSON_BYTES, media_type="application/json")
+
+async def _send_tg_message(chat_id: int, programs: List[Dict[str, Any]]):
+    """Отправляет подобранные программы пользователю в Telegram (фоновая задача)"""
+    try:
+        # Формируем сообщение
+        message_lines = ["🎉 <b>Мы подобрали для тебя программы!</b>\n"]
+        
+        for i, program in enumerate(programs, 1):
+            message_lines.append(f"<b>{i}. {program['name']}</b>")
+            message_lines.append(f"{program.get('details', '')[:100]}")
+            message_lines.append(f"🎬 <a href='{program.get('video_url', '#')}'>Видео</a> | 🛒 <a href='{program.get('photo_url', '#')}'>Заказать</a>\n")
+        
+        message_text = "\n".join(message_lines)
+        await bot.send_message(chat_id=chat_id, text=message_text)
+        log.info("✅ Сообщение отправлено пользователю %s", chat_id)
+        
+    except Exception as e:
+        log.error("❌ Ошибка отправки в Telegram: %s", e)
+
 
 @app.post("/webhook")
-async def webhook(data: QuizAnswers):
+async def webhook(data: QuizAnswers, background_tasks: BackgroundTasks):
     """
     Принимает данные формы и возвращает рекомендации.
+    Сообщение в Telegram отправляется уже после ответа клиенту.
     """
     uid = data.uid
     selected_tag = data.selected_tag
     history = data.history or []
     
-    print(f"📬 ПОЛУЧЕНЫ ДАННЫЕ:")
-    print(f"   - UID: {uid}")
-    print(f"   - Тег: {selected_tag}")
-    print(f"   - История: {history}")
+    log.debug("📬 Webhook: uid=%s, tag=%s, history=%s", uid, selected_tag, history)
     
-    # Загружаем программы и фильтруем по тегу
-    import json
-    try:
-        with open('programs.json', 'r', encoding='utf-8') as f:
-            all_programs = json.load(f)
-        
-        if selected_tag:
-            filtered = [p for p in all_programs if selected_tag in p.get('tags', [])]
-        else:
-            filtered = all_programs[:3]
-        
-        result_programs = filtered[:5] if filtered else all_programs[:3]
-    except Exception as e:
-        print(f"❌ Ошибка загрузки программ: {e}")
-        result_programs = []
+    # Фильтруем программы по тегу через инвертированный индекс
+    positions = TAG_INDEX.get(selected_tag, []) if selected_tag else []
     
-    # Формируем ответ
-    response_data = {
-        "status": "success",
-        "programs": result_programs,
-        "tag": selected_tag
-    }
+    if positions:
+        result_programs = [ALL_PROGRAMS[i] for i in positions[:WEBHOOK_MAX_PROGRAMS]]
+        programs_json = _WEBHOOK_PROGRAMS_JSON[selected_tag]
+    else:
+        result_programs = ALL_PROGRAMS[:WEBHOOK_DEFAULT_PROGRAMS]
+        programs_json = _DEFAULT_PROGRAMS_JSON
     
-    # Отправляем результат пользователю в Telegram
-    if BOT_TOKEN != "YOUR_BOT_TOKEN_HERE" and uid.isdigit() and result_programs:
-        try:
-            # Формируем сообщение
-            message_lines = ["🎉 <b>Мы подобрали для тебя программы!</b>\n"]
-            
-            for i, program in enumerate(result_programs, 1):
-                message_lines.append(f"<b>{i}. {program['name']}</b>")
-                message_lines.append(f"{program.get('details', '')[:100]}")
-                message_lines.append(f"🎬 <a href='{program.get('video_url', '#')}'>Видео</a> | 🛒 <a href='{program.get('photo_url', '#')}'>Заказать</a>\n")
-            
-            message_text = "\n".join(message_lines)
-            await bot.send_message(chat_id=int(uid), text=message_text)
-            print(f"✅ Сообщение отправлено пользователю {uid}")
-            
-        except Exception as e:
-            print(f"❌ Ошибка отправки в Telegram: {e}")
-            response_data["telegram_error"] = str(e)
+    # Формируем ответ из заранее сериализованных программ
+    response_body = (
+        b'{"status":"success","programs":[' + programs_json
+        + b'],"tag":' + orjson.dumps(selected_tag) + b'}'
+    )
     
-    return JSONResponse(content=response_data)
+    # Отправляем результат пользователю в Telegram (не задерживая ответ)
+    if BOT_TOKEN != "YOUR_BOT_TOKEN_HERE" and isinstance(uid, int) and result_programs:
+        background_tasks.add_task(_send_tg_message, uid, result_programs)
+    
+    return Response(content=response_body, media_type="application/json")
+
+
+_recommend = None  # recommendation.recommend после первой инициализации
+_recommender_lock = asyncio.Lock()  # Защищает первую инициализацию
+
+
+def _init_recommender():
+    """Импортирует recommendation (numpy) и строит TF-IDF по ALL_PROGRAMS"""
+    import recommendation
+    recommendation.use_programs(ALL_PROGRAMS)
+    return recommendation.recommend
+
+
+async def get_recommender():
+    """
+    TF-IDF (и numpy) нужны только /tilda-webhook, поэтому модуль
+    инициализируется при первом запросе — в потоке, не блокируя event loop.
+    """
+    global _recommend
+    if _recommend is None:
+        # Параллельные первые запросы ждут одну инициализацию, а не строят корпус заново
+        async with _recommender_lock:
+            if _recommend is None:
+                _recommend = await asyncio.to_thread(_init_recommender)
+    return _recommend
 
 
 @app.post("/tilda-webhook")
@@ -240,12 +443,13 @@ async def tilda_webhook(data: TildaWebhookData):
     uid = data.uid
     answers = data.answers
     
-    print(f"📬 Tilda webhook: uid={uid}, answers={answers}")
+    log.debug("📬 Tilda webhook: uid=%s, answers=%s", uid, answers)
     
     # Получаем рекомендации
+    recommend = await get_recommender()
     programs = recommend(answers, top_n=3)
     
-    return JSONResponse(content={
+    return ORJSONResponse(content={
         "status": "success",
         "programs": programs
     })
@@ -253,9 +457,8 @@ async def tilda_webhook(data: TildaWebhookData):
 
 @app.get("/programs")
 async def get_programs():
-    """Возвращает все программы (для отладки)"""
-    programs = load_programs()
-    return JSONResponse(content={"count": len(programs), "programs": programs})
+    """Возвращает все программы (для отладки) — из кэша в памяти, без I/O в event loop"""
+    return ORJSONResponse(content={"count": len(ALL_PROGRAMS), "programs": ALL_PROGRAMS})
 
 
 @app.get("/health")
@@ -3,68 +3,74 @@
 """
 
 import json
-from typing import List, Dict, Any
+import functools
+from typing import List, Dict, Any, Tuple, Optional, FrozenSet
 from collections import Counter
 import math
 
+import numpy as np
+
+# Корпус для recommend(): IDF, индекс тег → столбец,
+# позиции видимых программ и их TF-IDF матрица
+Corpus = Tuple[Dict[str, float], Dict[str, int], np.ndarray, np.ndarray]
+
+# Кэш корпуса. Зависит только от programs.json,
+# поэтому считается один раз (get_programs() / use_programs())
+_PROGRAMS: Optional[List[Dict[str, Any]]] = None
+_CORPUS: Optional[Corpus] = None
+
 
 def load_programs(filepath: str = "programs.json") -> List[Dict[str, Any]]:
     """Загружает программы из JSON файла"""
     with open(filepath, "r", encoding="utf-8") as f:
         data = json.load(f)
-    return data.get("programs", [])
+    return data if isinstance(data, list) else data.get("programs", [])
 
 
-def build_user_profile(answers: Dict[str, str]) -> List[str]:
-    """
-    Преобразует ответы пользователя в список тегов.
-    
-    Маппинг ответов на теги для алгоритма:
-    - mood: настроение → активный/расслабленный
-    - budget: бюджет → низкий_бюджет/средний_бюджет/высокий_бюджет
-    - company: компания → один/пара/компания
-    - time: время → утро/день/вечер/ночь
-    - location: локация → в_помещении/на_улице
-    - interests: интересы → спорт/творчество/еда/музыка/природа и т.д.
-    """
-    tags = []
-    
+def get_programs() -> List[Dict[str, Any]]:
+    """Программы корпуса recommend(): при первом вызове — из programs.json с кэшем TF-IDF"""
+    if _PROGRAMS is None:
+        use_programs(load_programs())
+    return _PROGRAMS
+
+
+def use_programs(programs: List[Dict[str, Any]]) -> None:
+    """Строит кэш TF-IDF по уже загруженному списку программ (без чтения файла)"""
+    global _PROGRAMS, _CORPUS
+    _CORPUS = build_corpus(programs)
+    _PROGRAMS = programs
+    _rank_cached.cache_clear()
+
+
+# Маппинг ответов квиза на теги алгоритма, по полям анкеты
+_ANSWER_MAPS: Dict[str, Dict[str, str]] = {
     # Настроение
-    mood_map = {
+    "mood": {
         "active": "активный",
         "relaxed": "расслабленный",
         "активный": "активный",
         "расслабленный": "расслабленный"
-    }
-    if answers.get("mood"):
-        tags.append(mood_map.get(answers["mood"], answers["mood"]))
-    
+    },
     # Бюджет
-    budget_map = {
+    "budget": {
         "low": "низкий_бюджет",
         "medium": "средний_бюджет",
         "high": "высокий_бюджет",
         "низкий": "низкий_бюджет",
         "средний": "средний_бюджет",
         "высокий": "высокий_бюджет"
-    }
-    if answers.get("budget"):
-        tags.append(budget_map.get(answers["budget"], answers["budget"]))
-    
+    },
     # Компания
-    company_map = {
+    "company": {
         "alone": "один",
         "couple": "пара",
         "friends": "компания",
         "один": "один",
         "пара": "пара",
         "компания": "компания"
-    }
-    if answers.get("company"):
-        tags.append(company_map.get(answers["company"], answers["company"]))
-    
+    },
     # Время суток
-    time_map = {
+    "time": {
         "morning": "утро",
         "day": "день",
         "evening": "вечер",
@@ -73,26 +79,16 @@ def build_user_profile(answers: Dict[str, str]) -> List[str]:
         "день": "день",
         "вечер": "вечер",
         "ночь": "ночь"
-    }
-    if answers.get("time"):
-        tags.append(time_map.get(answers["time"], answers["time"]))
-    
+    },
     # Локация
-    location_map = {
+    "location": {
         "indoor": "в_помещении",
         "outdoor": "на_улице",
         "в_помещении": "в_помещении",
         "на_улице": "на_улице"
-    }
-    if answers.get("location"):
-        tags.append(location_map.get(answers["location"], answers["location"]))
-    
-    # Интересы (может быть списком)
-    interests = answers.get("interests", [])
-    if isinstance(interests, str):
-        interests = [interests]
-    
-    interest_map = {
+    },
+    # Интересы
+    "interests": {
         "sport": "спорт",
         "creative": "творчество",
         "food": "еда",
@@ -103,32 +99,48 @@ def build_user_profile(answers: Dict[str, str]) -> List[str]:
         "games": "игры",
         "spa": "спа",
         "movies": "кино"
-    }
-    for interest in interests:
-        tags.append(interest_map.get(interest, interest))
-    
-    return tags
+    },
+}
+
+# Плоская таблица (поле, ответ) → тег — один lookup на ответ
+_ANSWER_TO_TAG: Dict[Tuple[str, str], str] = {
+    (field, answer): tag
+    for field, mapping in _ANSWER_MAPS.items()
+    for answer, tag in mapping.items()
+}
+
+# Поля с одиночным ответом (interests обрабатываются отдельно — это список)
+_SINGLE_FIELDS = ("mood", "budget", "company", "time", "location")
 
 
-def cosine_similarity(vec1: Dict[str, float], vec2: Dict[str, float]) -> float:
-    """Вычисляет косинусное сходство между двумя векторами"""
-    # Находим общие ключи
-    common_keys = set(vec1.keys()) & set(vec2.keys())
+def build_user_profile(answers: Dict[str, str]) -> List[str]:
+    """
+    Преобразует ответы пользователя в список тегов.
     
-    if not common_keys:
-        return 0.0
+    Маппинг ответов на теги для алгоритма:
+    - mood: настроение → активный/расслабленный
+    - budget: бюджет → низкий_бюджет/средний_бюджет/высокий_бюджет
+    - company: компания → один/пара/компания
+    - time: время → утро/день/вечер/ночь
+    - location: локация → в_помещении/на_улице
+    - interests: интересы → спорт/творчество/еда/музыка/природа и т.д.
     
-    # Скалярное произведение
-    dot_product = sum(vec1[k] * vec2[k] for k in common_keys)
+    Неизвестные ответы попадают в профиль как есть.
+    """
+    tags = [
+        _ANSWER_TO_TAG.get((field, answers[field]), answers[field])
+        for field in _SINGLE_FIELDS
+        if answers.get(field)
+    ]
     
-    # Нормы векторов
-    norm1 = math.sqrt(sum(v ** 2 for v in vec1.values()))
-    norm2 = math.sqrt(sum(v ** 2 for v in vec2.values()))
+    # Интересы (может быть списком)
+    interests = answers.get("interests") or []
+    if isinstance(interests, str):
+        interests = [interests]
     
-    if norm1 == 0 or norm2 == 0:
-        return 0.0
+    tags += [_ANSWER_TO_TAG.get(("interests", interest), interest) for interest in interests]
     
-    return dot_product / (norm1 * norm2)
+    return tags
 
 
 def tags_to_vector(tags: List[str]) -> Dict[str, float]:
@@ -148,12 +160,12 @@ def build_idf(programs: List[Dict[str, Any]]) -> Dict[str, float]:
         for tag in unique_tags:
             tag_doc_count[tag] += 1
     
-    # IDF = log(N / df)
-    idf = {}
-    for tag, count in tag_doc_count.items():
-        idf[tag] = math.log(num_programs / count) + 1  # +1 для сглаживания
+    # IDF = log(N / df) + 1 (сглаживание) — одним векторным вызовом
+    tags = list(tag_doc_count)
+    counts = np.fromiter((tag_doc_count[tag] for tag in tags), dtype=np.int32, count=len(tags))
+    idf_values = np.log(num_programs / counts) + 1.0
     
-    return idf
+    return dict(zip(tags, idf_values.tolist()))
 
 
 def apply_tfidf(tf_vector: Dict[str, float], idf: Dict[str, float]) -> Dict[str, float]:
@@ -161,6 +173,89 @@ def apply_tfidf(tf_vector: Dict[str, float], idf: Dict[str, float]) -> Dict[str,
     return {tag: tf * idf.get(tag, 1.0) for tag, tf in tf_vector.items()}
 
 
+def build_tfidf_matrix(
+    programs: List[Dict[str, Any]], idf: Dict[str, float]
+) -> Tuple[Dict[str, int], np.ndarray]:
+    """
+    Строит матрицу TF-IDF программ M[P, T] (float64, строки L2-нормированы)
+    и индекс тег → номер столбца.
+    """
+    tag_index = {tag: col for col, tag in enumerate(idf)}
+    matrix = np.zeros((len(programs), len(tag_index)), dtype=np.float64)
+    
+    for row, program in enumerate(programs):
+        program_tfidf = apply_tfidf(tags_to_vector(program.get("tags", [])), idf)
+        for tag, weight in program_tfidf.items():
+            matrix[row, tag_index[tag]] = weight
+    
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0  # Программы без тегов остаются нулевыми
+    matrix /= norms
+    
+    return tag_index, matrix
+
+
+def build_corpus(programs: List[Dict[str, Any]]) -> Corpus:
+    """
+    Всё, что нужно recommend() от корпуса. Скрытые программы учитываются в IDF,
+    но в матрицу попадают только видимые — на запросе их не нужно отфильтровывать.
+    """
+    idf = build_idf(programs)
+    tag_index, matrix = build_tfidf_matrix(programs, idf)
+    candidates = np.flatnonzero([program.get("visible", True) for program in programs])
+    return idf, tag_index, candidates, matrix[candidates]
+
+
+def rank_programs(
+    tag_counts: Dict[str, int], corpus: Corpus, top_n: int
+) -> Tuple[Tuple[int, float], ...]:
+    """
+    Ранжирует программы корпуса по косинусному сходству с профилем
+    (тег → сколько раз он встретился в ответах).
+    Возвращает до top_n пар (позиция программы, score) по убыванию score.
+    """
+    idf, tag_index, candidates, matrix = corpus
+    
+    # Плотный TF-IDF вектор пользователя за один проход по его тегам.
+    # TF берём как count без деления на число тегов: косинус от масштаба не зависит.
+    # Норма считается по всем тегам, включая отсутствующие в программах (IDF = 1)
+    user_vec = np.zeros(len(tag_index), dtype=np.float64)
+    norm_sq = 0.0
+    for tag, count in tag_counts.items():
+        weight = count * idf.get(tag, 1.0)
+        norm_sq += weight * weight
+        col = tag_index.get(tag)
+        if col is not None:
+            user_vec[col] = weight
+    user_vec /= math.sqrt(norm_sq)
+    
+    # Косинусное сходство со всеми видимыми программами — одно умножение M @ u
+    candidate_scores = matrix @ user_vec
+    
+    if top_n <= 0:
+        return ()
+    
+    # Top-N за O(P): partition находит score N-й программы, дальше стабильно
+    # сортируем только программы не хуже него (включая всех, кто делит N-е место),
+    # чтобы при равных score побеждала ранняя программа
+    if top_n < len(candidates):
+        kth_score = -np.partition(-candidate_scores, top_n - 1)[top_n - 1]
+        top = np.flatnonzero(candidate_scores >= kth_score)
+    else:
+        top = np.arange(len(candidates))
+    top = top[np.argsort(-candidate_scores[top], kind="stable")][:top_n]
+    
+    return tuple((int(candidates[i]), float(candidate_scores[i])) for i in top)
+
+
+@functools.lru_cache(maxsize=4096)
+def _rank_cached(
+    profile_key: FrozenSet[Tuple[Any, int]], top_n: int
+) -> Tuple[Tuple[int, float], ...]:
+    """rank_programs() по кэшированному корпусу с мемоизацией по профилю"""
+    return rank_programs(dict(profile_key), _CORPUS, top_n)
+
+
 def recommend(
     user_answers: Dict[str, str], 
     programs: List[Dict[str, Any]] = None,
@@ -169,9 +264,13 @@ def recommend(
     """
     Основная функция рекомендаций.
     Возвращает top_n программ, отсортированных по релевантности.
+    
+    Для программ из programs.json результат мемоизируется: ответы квиза
+    берутся из маленького конечного множества и часто повторяются.
     """
-    if programs is None:
-        programs = load_programs()
+    use_cache = programs is None
+    if use_cache:
+        programs = get_programs()
     
     # Строим профиль пользователя
     user_tags = build_user_profile(user_answers)
@@ -180,39 +279,26 @@ def recommend(
         # Если нет тегов — возвращаем первые N программ
         return programs[:top_n]
     
-    # Вычисляем IDF
-    idf = build_idf(programs)
-    
-    # TF-IDF вектор пользователя
-    user_tf = tags_to_vector(user_tags)
-    user_tfidf = apply_tfidf(user_tf, idf)
-    
-    # Вычисляем сходство для каждой программы
-    scored_programs = []
-    for program in programs:
-        if not program.get("visible", True):
-            continue
-            
-        program_tags = program.get("tags", [])
-        program_tf = tags_to_vector(program_tags)
-        program_tfidf = apply_tfidf(program_tf, idf)
-        
-        score = cosine_similarity(user_tfidf, program_tfidf)
-        scored_programs.append((score, program))
-    
-    # Сортируем по убыванию score
-    scored_programs.sort(key=lambda x: x[0], reverse=True)
+    # Score зависит только от мультимножества тегов — порядок ответов не важен.
+    # Ключ без сортировки: в ответах Tilda могут быть не только строки
+    tag_counts = Counter(user_tags)
+    if use_cache:
+        ranked = _rank_cached(frozenset(tag_counts.items()), top_n)
+    else:
+        # Чужой список программ — кэш к нему не подходит
+        ranked = rank_programs(tag_counts, build_corpus(programs), top_n)
     
     # Возвращаем top_n программ (без score)
     result = []
-    for score, program in scored_programs[:top_n]:
+    for position, score in ranked:
+        program = programs[position]
         result.append({
-            "id": program["id"],
+            "id": program.get("id"),
             "name": program["name"],
-            "details": program["details"],
-            "video_url": program["video_url"],
-            "photo_url": program["photo_url"],
-            "visible": program["visible"],
+            "details": program.get("details", ""),
+            "video_url": program.get("video_url", "#"),
+            "photo_url": program.get("photo_url", "#"),
+            "visible": program.get("visible", True),
             "score": round(score, 3)  # Для отладки
         })
     